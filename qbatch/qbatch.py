@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 import argparse
+import configparser
+import copy
 import math
 import os
 from importlib.metadata import version
 import re
+import shlex
+import shutil
 import subprocess
 import stat
 import sys
 import fnmatch
 import errno
+import hashlib
 from io import open
 from textwrap import dedent
 
@@ -128,10 +133,371 @@ def _setupVars():
     cd {workdir}
     """)
 
+    global PARALLEL_CHECK
+    PARALLEL_CHECK = ('command -v parallel > /dev/null 2>&1 || { echo "GNU'
+                      ' parallel not found in job environment. Exiting.";'
+                      ' exit 1; }')
+
+    # records the largest resident set size of the commands in a job using
+    # GNU time, if it is available
+    global TIME_TEMPLATE
+    TIME_TEMPLATE = dedent(
+        """\
+    qbatch_time() {{
+        if [ -x /usr/bin/time ]; then
+            /usr/bin/time -a -o "{maxrss}" -f %M "$@"
+        else
+            "$@"
+        fi
+    }}
+    """)
+
+    # pins each GNU parallel job slot to its own THREADS_PER_COMMAND CPUs,
+    # taken from the CPUs the job may use in NUMA node order, by running the
+    # commands through the PIN_SHELL_TEMPLATE script
+    global PIN_TEMPLATE
+    PIN_TEMPLATE = dedent(
+        """\
+    qbatch_pin() {
+        if command -v taskset > /dev/null 2>&1; then
+            eval "$(awk -v cores="$CORES" -v threads="$THREADS_PER_COMMAND" '
+            function expand(list, out,    parts, range, i, j, k, n) {
+                n = split(list, parts, ",")
+                k = 0
+                for (i = 1; i <= n; i++) {
+                    if (split(parts[i], range, "-") == 1)
+                        range[2] = range[1]
+                    for (j = range[1] + 0; j <= range[2] + 0; j++)
+                        out[++k] = j
+                }
+                return k
+            }
+            BEGIN {
+                while ((getline line < "/proc/self/status") > 0)
+                    if (sub(/^Cpus_allowed_list:[ \\t]*/, "", line))
+                        nallowed = expand(line, allowed)
+                for (i = 1; i <= nallowed; i++)
+                    isallowed[allowed[i]] = 1
+                n = 0
+                nodes = "/sys/devices/system/node/node"
+                for (node = 0; (getline line < (nodes node "/cpulist")) > 0;
+                     node++) {
+                    m = expand(line, cpus)
+                    for (i = 1; i <= m; i++)
+                        if ((cpus[i] in isallowed) && !(cpus[i] in used)) {
+                            order[++n] = cpus[i]
+                            used[cpus[i]] = 1
+                        }
+                }
+                for (i = 1; i <= nallowed; i++)
+                    if (!(allowed[i] in used))
+                        order[++n] = allowed[i]
+                if (n == 0)
+                    exit
+                if (cores ~ /%$/)
+                    slots = int(n * substr(cores, 1, length(cores) - 1) / 100)
+                else
+                    slots = cores + 0
+                threads = threads + 0 < 1 ? 1 : threads + 0
+                for (s = 1; s <= slots; s++) {
+                    list = order[((s - 1) * threads) % n + 1]
+                    for (i = 1; i < threads; i++)
+                        list = list "," order[((s - 1) * threads + i) % n + 1]
+                    print "export QBATCH_CPUS_" s "=" list
+                }
+            }')"
+            PARALLEL_SHELL=$QBATCH_PIN_SHELL
+            export PARALLEL_SHELL
+        fi
+        "$@"
+    }
+    """)
+
+    global PIN_SHELL_TEMPLATE
+    PIN_SHELL_TEMPLATE = dedent(
+        """\
+    #!/bin/sh
+    # runs a command from GNU parallel on the CPUs of its job slot, in the
+    # shell the job script runs commands with
+    eval "QBATCH_SLOT_CPUS=\\${{QBATCH_CPUS_${{PARALLEL_JOBSLOT:-0}}:-}}"
+    if [ -n "$QBATCH_SLOT_CPUS" ]; then
+        exec taskset -c "$QBATCH_SLOT_CPUS" {shell} "$@"
+    fi
+    exec {shell} "$@"
+    """)
+
+    # runs one command in a subshell of a persistent worker shell, tagging
+    # its output with the command once it finishes
+    global WORKER_TEMPLATE
+    WORKER_TEMPLATE = dedent(
+        """\
+    qbatch_run() {
+        ( eval "$qbatch_cmd" ) < /dev/null > "$1.out" 2>&1
+        qbatch_rc=$?
+        while IFS= read -r qbatch_line || [ -n "$qbatch_line" ]; do
+            printf '%s\\t%s\\n' "$qbatch_cmd" "$qbatch_line"
+        done < "$1.out"
+        if [ $qbatch_rc -ne 0 ]; then
+            qbatch_failed=$((qbatch_failed + 1))
+            echo "qbatch: exit status $qbatch_rc: $qbatch_cmd" >&2
+        fi
+        printf '%d\\t%s\\t0\\t-\\t0\\t0\\t%d\\t0\\t%s\\n' \\
+            $qbatch_seq "$QBATCH_HOST" $qbatch_rc "$qbatch_cmd" >> "$1.joblog"
+    }
+    qbatch_start() {
+        QBATCH_WORK_DIR=$(mktemp -d "${TMPDIR:-/tmp}/qbatch.XXXXXX") || exit 1
+        QBATCH_HOST=$(hostname)
+        case $CORES in
+            *%) QBATCH_CORES=$(( $(nproc) * ${CORES%\\%} / 100 ));;
+            *) QBATCH_CORES=$CORES;;
+        esac
+        [ $QBATCH_CORES -lt 1 ] && QBATCH_CORES=1
+    }
+    qbatch_finish() {
+        wait
+        [ -n "$1" ] && cat "$QBATCH_WORK_DIR"/*.joblog >> "$1" 2> /dev/null
+        QBATCH_FAILED=$(awk '{s += $1} END {print s + 0}' \\
+            "$QBATCH_WORK_DIR"/*.failed)
+        rm -rf "$QBATCH_WORK_DIR"
+        [ $QBATCH_FAILED -gt 101 ] && QBATCH_FAILED=101
+        return $QBATCH_FAILED
+    }
+    """)
+
+    # runs the commands read from stdin in CORES persistent shells, without
+    # GNU parallel
+    global MICRO_TEMPLATE
+    MICRO_TEMPLATE = dedent(
+        """\
+    qbatch_worker() {
+        qbatch_seq=$2
+        qbatch_failed=0
+        while IFS= read -r qbatch_cmd; do
+            qbatch_run "$1"
+            qbatch_seq=$((qbatch_seq + QBATCH_CORES))
+        done
+        echo $qbatch_failed > "$1.failed"
+    }
+    qbatch_micro() {
+        qbatch_start
+        awk 'NF' > "$QBATCH_WORK_DIR/commands"
+        QBATCH_SLOT=1
+        while [ $QBATCH_SLOT -le $QBATCH_CORES ]; do
+            awk -v n=$QBATCH_CORES -v k=$QBATCH_SLOT 'NR % n == k % n' \\
+                "$QBATCH_WORK_DIR/commands" |
+                qbatch_worker "$QBATCH_WORK_DIR/$QBATCH_SLOT" $QBATCH_SLOT &
+            QBATCH_SLOT=$((QBATCH_SLOT + 1))
+        done
+        qbatch_finish "$1"
+    }
+    """)
+
+    # runs CORES persistent shells which each claim the next block of
+    # commands of the shared queue QBATCH_QUEUE (a directory of numbered
+    # block files) until it is empty. Claims are counted in
+    # QBATCH_QUEUE.claimed, under a lock directory (mkdir is atomic, also on
+    # shared filesystems) whose owner file records the host, process and
+    # slot holding it. The lock is held for a lease of a minute: it is
+    # broken once its owner file is older than that, or sooner when its
+    # owner was on this host and has been killed.
+    global DYNAMIC_TEMPLATE
+    DYNAMIC_TEMPLATE = dedent(
+        """\
+    qbatch_stale() {
+        [ -n "$(find "$QBATCH_QUEUE.lock/owner" -mmin +1 2> /dev/null)" ] ||
+            { [ "$qbatch_host" = "$QBATCH_HOST" ] &&
+                ! kill -0 "$qbatch_pid" 2> /dev/null; }
+    }
+    qbatch_lock() {
+        qbatch_lock="$QBATCH_QUEUE.lock"
+        qbatch_aside="$qbatch_lock/owner.$QBATCH_HOST.$$.$1"
+        until mkdir "$qbatch_lock" 2> /dev/null; do
+            if read -r qbatch_host qbatch_pid qbatch_slot \\
+                    2> /dev/null < "$qbatch_lock/owner" && qbatch_stale &&
+                mv "$qbatch_lock/owner" "$qbatch_aside" 2> /dev/null; then
+                # break the lock only if the stale owner still holds it
+                read -r qbatch_moved < "$qbatch_aside"
+                qbatch_owner="$qbatch_host $qbatch_pid $qbatch_slot"
+                if [ "$qbatch_moved" = "$qbatch_owner" ]; then
+                    rm -rf "$qbatch_lock"
+                    continue
+                fi
+                mv "$qbatch_aside" "$qbatch_lock/owner" 2> /dev/null
+            fi
+            sleep 0.1
+        done
+        echo "$QBATCH_HOST $$ $1" > "$qbatch_lock/owner"
+    }
+    qbatch_unlock() {
+        # a lock broken after its lease belongs to someone else by now
+        read -r qbatch_owner 2> /dev/null < "$QBATCH_QUEUE.lock/owner" &&
+            [ "$qbatch_owner" = "$QBATCH_HOST $$ $1" ] &&
+            rm -rf "$QBATCH_QUEUE.lock"
+    }
+    qbatch_claim() {
+        qbatch_lock $1
+        read -r qbatch_block < "$QBATCH_QUEUE.claimed"
+        qbatch_block=$((qbatch_block + 1))
+        echo $qbatch_block > "$QBATCH_QUEUE.claimed"
+        qbatch_unlock $1
+        [ $qbatch_block -le $QBATCH_QUEUE_BLOCKS ]
+    }
+    qbatch_stealer() {
+        qbatch_failed=0
+        while qbatch_claim $2; do
+            qbatch_seq=$(( (qbatch_block - 1) * QBATCH_BLOCK_SIZE ))
+            while IFS= read -r qbatch_cmd; do
+                qbatch_seq=$((qbatch_seq + 1))
+                qbatch_run "$1"
+            done < "$QBATCH_QUEUE/$qbatch_block"
+        done
+        echo $qbatch_failed > "$1.failed"
+    }
+    qbatch_dynamic() {
+        qbatch_start
+        QBATCH_SLOT=1
+        while [ $QBATCH_SLOT -le $QBATCH_CORES ]; do
+            qbatch_stealer "$QBATCH_WORK_DIR/$QBATCH_SLOT" $QBATCH_SLOT &
+            QBATCH_SLOT=$((QBATCH_SLOT + 1))
+        done
+        qbatch_finish "$1"
+    }
+    """)
+
+    # node-local staging of the inputs and outputs of a chunk of commands
+    global STAGE_IN_TEMPLATE
+    STAGE_IN_TEMPLATE = dedent(
+        """\
+    {{ printf '%s\\n' {stage_in}; {extract} }} | sort -u |
+    while IFS= read -r QBATCH_PATH; do
+        case "$QBATCH_PATH" in /*) continue ;; esac
+        [ -e "$QBATCH_PATH" ] && printf '%s\\n' "$QBATCH_PATH"
+    done | tar -cf - -T - | (cd "$QBATCH_STAGE_DIR" && tar -xf -)
+    cd "$QBATCH_STAGE_DIR"
+    """)
+
+    global STAGE_OUT_TEMPLATE
+    STAGE_OUT_TEMPLATE = dedent(
+        """\
+    QBATCH_RC=$?
+    for QBATCH_PATH in {stage_out}; do
+        [ -e "$QBATCH_PATH" ] && printf '%s\\n' "$QBATCH_PATH"
+    done | tar -cf - -T - | (cd {workdir} && tar -xf -)
+    cd {workdir}
+    rm -rf "$QBATCH_STAGE_DIR"
+    (exit $QBATCH_RC)
+    """)
+
+    # expands the commands first to first + count - 1 of a parameter sweep,
+    # read as "source<TAB>value" lines, where source 0 is the template and
+    # the last source varies fastest (or all together when linked)
+    global SWEEP_PROGRAM
+    SWEEP_PROGRAM = dedent(
+        """\
+    BEGIN { FS = "\\t" }
+    {
+        j = $1 + 0
+        n[j]++
+        value[j, n[j]] = substr($0, length($1) + 2)
+        if (j > sources)
+            sources = j
+    }
+    END {
+        total = link ? 0 : 1
+        for (j = 1; j <= sources; j++)
+            total = link ? (n[j] > total ? n[j] : total) : total * n[j]
+        for (k = first - 1; k < first - 1 + count && k < total; k++) {
+            rest = k
+            for (j = sources; j >= 1; j--) {
+                idx[j] = (link ? k : rest) % n[j] + 1
+                rest = int(rest / n[j])
+            }
+            line = ""
+            text = value[0, 1]
+            while (match(text, /\\{[0-9]*\\}/)) {
+                j = 1
+                if (RLENGTH > 2)
+                    j = substr(text, RSTART + 1, RLENGTH - 2) + 0
+                field = (j in idx) ? value[j, idx[j]] : \\
+                    substr(text, RSTART, RLENGTH)
+                line = line substr(text, 1, RSTART - 1) field
+                text = substr(text, RSTART + RLENGTH)
+            }
+            print line text
+        }
+    }""")
+
     global __varsSet
     __varsSet = True
 
 
+def chunk_runner(job_name, index, joblog_dir=None, record_usage=False,
+                 micro=False, pin_shell=None, dynamic=False):
+    """Builds the command which runs a chunk of commands read from stdin
+
+    If pin_shell (the path of a script made from PIN_SHELL_TEMPLATE) is
+    given, each GNU parallel job slot is pinned to its own CPUs. A dynamic
+    runner reads no commands, but takes them from the shared queue.
+
+    Returns a tuple of (lines defining what the runner needs, runner command).
+    """
+    joblog = joblog_dir and record_path(joblog_dir, job_name, index, 'joblog')
+    if micro or dynamic:
+        template = dynamic and DYNAMIC_TEMPLATE or MICRO_TEMPLATE
+        runner = ((dynamic and 'qbatch_dynamic' or 'qbatch_micro') +
+                  (joblog and ' "{0}"'.format(joblog) or ''))
+        return [WORKER_TEMPLATE + template.rstrip('\n')], runner
+
+    prelude = [PARALLEL_CHECK]
+    runner = 'parallel -j${CORES} --tag --line-buffer --compress'
+    if joblog:
+        runner += ' --joblog "+{0}"'.format(joblog)
+    if record_usage:
+        prelude.append(TIME_TEMPLATE.format(maxrss=record_path(
+            joblog_dir, job_name, index, 'maxrss')).rstrip('\n'))
+        runner = 'qbatch_time ' + runner
+    if pin_shell:
+        prelude += ['QBATCH_PIN_SHELL="{0}"'.format(pin_shell),
+                    PIN_TEMPLATE.rstrip('\n')]
+        runner = 'qbatch_pin ' + runner
+    return prelude, runner
+
+
+def chunk_lines(commands, runner, source=None, workdir=None, stage_in=None,
+                stage_out=None, stage_regex=None):
+    """Script lines which feed a chunk of commands to a runner
+
+    commands is the text of the command list, embedded in the script as a
+    here-document, and source an optional command (e.g. sed) which selects
+    the chunk from it. When staging is requested, the commands run in a
+    node-local directory to which the stage_in paths (and the paths matching
+    stage_regex in the chunk) are first copied, and from which the stage_out
+    paths are copied back to workdir.
+
+    Returns a list of lines.
+    """
+    if not (stage_in or stage_out or stage_regex):
+        if source:
+            return [source + " << 'EOF' | " + runner, commands, 'EOF']
+        return [runner + " << 'EOF'", commands, 'EOF']
+
+    commands_file = '"$QBATCH_STAGE_DIR/.qbatch-commands"'
+    extract = stage_regex and 'grep -oE -- {0} {1};'.format(
+        shlex.quote(stage_regex), commands_file) or ''
+    return [
+        'QBATCH_STAGE_DIR=$(mktemp -d "${TMPDIR:-/tmp}/qbatch.XXXXXX")'
+        ' || exit 1',
+        'export QBATCH_STAGE_DIR',
+        (source or 'cat') + " << 'EOF' > " + commands_file,
+        commands,
+        'EOF',
+        STAGE_IN_TEMPLATE.format(stage_in=' '.join(stage_in or []),
+                                 extract=extract).rstrip('\n'),
+        runner + ' < ' + commands_file,
+        STAGE_OUT_TEMPLATE.format(stage_out=' '.join(stage_out or []),
+                                  workdir=shlex.quote(workdir)).rstrip('\n')]
+
+
 def run_command(command, logfile=None):
     # Run command and collect stdout
     # http://blog.endpoint.com/2015/01/getting-realtime-output-using-python.html # noqa
@@ -199,6 +565,45 @@ def int_or_percent(string):
     return string
 
 
+def sweep_values(string):
+    """Splits an inline list of parameter sweep values, like the arguments
+    given to GNU parallel after :::"""
+    values = shlex.split(string)
+    if not values:
+        raise argparse.ArgumentTypeError("Must give at least one value")
+    return values
+
+
+def sweep_file(string):
+    """Reads a file of parameter sweep values, one per line, like the files
+    given to GNU parallel after ::::"""
+    try:
+        with open(string, 'r', encoding="utf-8") as f:
+            values = [line.rstrip('\n') for line in f if line.strip()]
+    except (IOError, OSError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if not values:
+        raise argparse.ArgumentTypeError("{0} is empty".format(string))
+    return values
+
+
+def sweep_size(sources, link=False):
+    """Number of commands in a parameter sweep over the given value lists"""
+    if link:
+        return max(len(values) for values in sources)
+    size = 1
+    for values in sources:
+        size *= len(values)
+    return size
+
+
+def sweep_source(first, count, link=False):
+    """Command which expands commands first to first + count - 1 of a
+    parameter sweep, reading the template and values on stdin"""
+    return "awk -v first={0} -v count={1} -v link={2} '\n{3}'".format(
+        first, count, link and 1 or 0, SWEEP_PROGRAM)
+
+
 def compute_threads(ppj, ncores):
     """Computes either number cores per job available"""
     if not ppj:
@@ -209,6 +614,217 @@ def compute_threads(ppj, ncores):
         return int(ppj) // int(ncores)
 
 
+def command_hash(command):
+    """Returns a hash of a command line with its whitespace normalized"""
+    return hashlib.sha1(
+        ' '.join(command.split()).encode('utf-8')).hexdigest()
+
+
+def unique_commands(task_list):
+    """Removes duplicate commands, keeping the first occurrence of each
+
+    Commands are compared by their digest, so the set of commands already
+    seen costs a fixed size per command on top of the command list, which
+    qbatchDriver holds in memory anyway.
+
+    Returns the list of unique commands.
+    """
+    seen = set()
+    unique = []
+    for command in task_list:
+        digest = hashlib.sha1(
+            command.rstrip('\n').encode('utf-8')).digest()
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(command)
+    return unique
+
+
+def command_keys(task_list, pattern):
+    """Extracts a grouping key from each command using a regular expression
+
+    The key is the first group of the match, or the whole match if the
+    expression has no groups. Commands which do not match have no key.
+
+    Returns a list of keys (or None), one per command.
+    """
+    regex = re.compile(pattern)
+    keys = []
+    for command in task_list:
+        match = regex.search(command)
+        if match:
+            keys.append(match.group(1) if regex.groups else match.group(0))
+        else:
+            keys.append(None)
+    return keys
+
+
+def group_commands(task_list, keys, chunk_size=None):
+    """Reorders commands so that commands sharing a key are adjacent
+
+    Groups are ordered by the first occurrence of their key, and commands
+    keep their original order within a group. When chunk_size is given,
+    the groups are packed into chunks of that size: a group which does not
+    fit in the space left in a chunk starts the next one, the space being
+    padded with no-op (:) commands, so that only groups larger than
+    chunk_size are split across chunks.
+
+    Returns a tuple of the reordered (commands, keys).
+    """
+    groups = []
+    index_of = {}
+    for command, key in zip(task_list, keys):
+        # the last command may not be newline terminated
+        command = command.rstrip('\n') + '\n'
+        if key is None:
+            groups.append((key, [command]))
+        elif key in index_of:
+            groups[index_of[key]][1].append(command)
+        else:
+            index_of[key] = len(groups)
+            groups.append((key, [command]))
+
+    commands = []
+    grouped_keys = []
+    for key, group in groups:
+        if chunk_size:
+            left = -len(commands) % chunk_size
+            # pad unless the group fits, or spans no more chunks than it
+            # would from the start of the next chunk
+            if left and len(group) > left and (
+                    1 + math.ceil((len(group) - left) / float(chunk_size)) >
+                    math.ceil(len(group) / float(chunk_size))):
+                commands += [':\n'] * left
+                grouped_keys += [None] * left
+        commands += group
+        grouped_keys += [key] * len(group)
+    return commands, grouped_keys
+
+
+def chunk_reads(keys, chunk_size):
+    """Counts how many chunks need the input named by each key
+
+    Returns a dictionary mapping each key to a number of chunks.
+    """
+    chunks = {}
+    for index, key in enumerate(keys):
+        if key is not None:
+            chunks.setdefault(key, set()).add(index // chunk_size)
+    return dict((key, len(value)) for key, value in chunks.items())
+
+
+def completed_commands(joblog_dir):
+    """Finds commands which completed successfully in previous runs
+
+    Reads the GNU parallel job logs written by job scripts into joblog_dir.
+
+    Returns a set of command hashes (see command_hash).
+    """
+    completed = set()
+    if not os.path.isdir(joblog_dir):
+        return completed
+
+    for name in os.listdir(joblog_dir):
+        if not name.endswith('.joblog'):
+            continue
+        with open(os.path.join(joblog_dir, name), 'r',
+                  encoding="utf-8") as joblog:
+            for line in joblog:
+                # Seq Host Starttime JobRuntime Send Receive Exitval Signal
+                # Command
+                fields = line.rstrip('\n').split('\t', 8)
+                if len(fields) < 9:
+                    continue
+                if fields[6] == '0' and fields[7] == '0':
+                    completed.add(command_hash(fields[8]))
+    return completed
+
+
+def record_path(joblog_dir, job_name, index, extension):
+    """Path of a file used by a job script to record how its commands ran"""
+    return os.path.join(joblog_dir,
+                        "{0}.{1}.{2}".format(job_name, index, extension))
+
+
+def resource_history(joblog_dir, job_name):
+    """Collects the observed resource usage of previous runs of a job
+
+    Runtimes are read from the job logs of successful commands, and peak
+    memory from the maximum resident set size recorded for each job.
+
+    Returns a tuple of lists (runtimes in seconds, peak memory in kilobytes).
+    """
+    runtimes = []
+    peaks = []
+    if not os.path.isdir(joblog_dir):
+        return runtimes, peaks
+
+    pattern = re.compile(r"^{0}\.\d+\.(joblog|maxrss)$".format(
+        re.escape(job_name)))
+    for name in os.listdir(joblog_dir):
+        match = pattern.match(name)
+        if not match:
+            continue
+        with open(os.path.join(joblog_dir, name), 'r',
+                  encoding="utf-8") as record:
+            for line in record:
+                if match.group(1) == 'maxrss':
+                    # GNU time may also note a non-zero exit status
+                    if line.strip().isdigit():
+                        peaks.append(int(line))
+                    continue
+                fields = line.rstrip('\n').split('\t', 8)
+                if len(fields) < 9 or fields[6] != '0':
+                    continue
+                try:
+                    runtimes.append(float(fields[3]))
+                except ValueError:
+                    pass
+    return runtimes, peaks
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a list of values"""
+    ordered = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def auto_resources(joblog_dir, job_name, system, num_tasks, chunk_size,
+                   concurrency, percent, margin):
+    """Computes mem and walltime requests for each job from usage history
+
+    Each job runs up to concurrency commands at once, so the memory request
+    is the per-command peak times concurrency, and the walltime request is
+    the per-command runtime times the number of commands each parallel slot
+    runs in turn. Both are taken at the given percentile and padded by the
+    given margin (a percentage).
+
+    Returns a tuple (mem, walltime), with None for any value without history.
+    """
+    runtimes, peaks = resource_history(joblog_dir, job_name)
+    concurrency = max(1, min(concurrency, chunk_size, num_tasks))
+    scale = 1 + margin / 100.0
+
+    mem = None
+    if peaks:
+        megabytes = int(math.ceil(
+            percentile(peaks, percent) * concurrency * scale / 1024))
+        mem = (system == 'pbs' and "{0}mb" or "{0}M").format(megabytes)
+
+    walltime = None
+    if runtimes:
+        per_slot = int(math.ceil(min(chunk_size, num_tasks) /
+                                 float(concurrency)))
+        seconds = int(math.ceil(
+            percentile(runtimes, percent) * per_slot * scale))
+        seconds = max(seconds, 60)
+        walltime = "{0}:{1:02d}:{2:02d}".format(
+            seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+    return mem, walltime
+
+
 def pbs_find_jobs(patterns):
     """Finds jobs with names matching a given list of patterns
 
@@ -291,6 +907,446 @@ def slurm_find_jobs(patterns):
     return regular_matches
 
 
+def submitted_job_id(system, output):
+    """Extracts the job ID from the output of qsub or sbatch
+
+    Returns the job ID, or None if it could not be found.
+    """
+    if system == 'slurm':
+        # Submitted batch job 1234
+        match = re.search(r"Submitted batch job (\d+)", output)
+    elif system == 'sge':
+        # Your job 1234 ("name") has been submitted
+        # Your job-array 1234.1-10:1 ("name") has been submitted
+        match = re.search(r"Your job(?:-array)? (\d+)", output)
+    else:
+        # 1234.server or 1234[].server
+        match = re.search(r"^(\d+(?:\[\])?\S*)\s*$", output, re.MULTILINE)
+    return match and match.group(1) or None
+
+
+def workflow_stages(workflow_file):
+    """Reads a workflow description
+
+    The workflow is an INI file with a section per stage. Each stage gives
+    its command_file (or template), the stages it depends on (depends), and
+    any other qbatch long options (e.g. mem = 4G, or individual = true).
+
+    Returns a list of (stage name, options) tuples, ordered so that each
+    stage comes after the stages it depends on.
+
+    Raises a ValueError if the workflow is invalid.
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    if not config.read(workflow_file, encoding="utf-8"):
+        raise ValueError("cannot read {0}".format(workflow_file))
+
+    stages = dict((name, dict(config.items(name)))
+                  for name in config.sections())
+    for name, options in stages.items():
+        if 'command_file' not in options and 'template' not in options:
+            raise ValueError("stage {0} has no command_file or "
+                             "template".format(name))
+        options['depends'] = options.get('depends', '').replace(
+            ',', ' ').split()
+        for upstream in options['depends']:
+            if upstream not in stages:
+                raise ValueError("stage {0} depends on unknown stage "
+                                 "{1}".format(name, upstream))
+
+    ordered = []
+    remaining = config.sections()
+    while remaining:
+        ready = [name for name in remaining
+                 if all(upstream in dict(ordered)
+                        for upstream in stages[name]['depends'])]
+        if not ready:
+            raise ValueError("circular dependency between stages "
+                             "{0}".format(', '.join(remaining)))
+        for name in ready:
+            ordered.append((name, stages[name]))
+            remaining.remove(name)
+    return ordered
+
+
+def submit_workflow(parser, args):
+    """Submits each stage of a workflow, depending on its upstream job IDs
+
+    Options given on the command line apply to every stage, unless a stage
+    overrides them. Options which can be given multiple times are replaced,
+    not added to, and flags can only be turned on by a stage.
+    """
+    try:
+        stages = workflow_stages(args.workflow)
+    except (ValueError, configparser.Error) as e:
+        sys.exit("qbatch: error: invalid workflow: {0}".format(str(e)))
+
+    # options taking no value, and the destinations of the options which can
+    # be given multiple times
+    flags = ['dryrun', 'verbose', 'individual', 'block', 'link', 'dynamic',
+             'pin', 'micro', 'auto_resources', 'dedup', 'skip_completed']
+    lists = {'depend': 'depend', 'options': 'options', 'header': 'header',
+             'footer': 'footer', 'pbs_nodes_spec': 'pbs_nodes_spec',
+             'args': 'sweep', 'args_file': 'sweep', 'stage_in': 'stage_in',
+             'stage_out': 'stage_out'}
+
+    upstreams = set(upstream for _, options in stages
+                    for upstream in options['depends'])
+    job_ids = {}
+    for name, options in stages:
+        stage = copy.deepcopy(args)
+        stage_args = []
+        for key, value in options.items():
+            dest = key.replace('-', '_')
+            if dest in ['command_file', 'depends']:
+                continue
+            option = '--' + dest.replace('_', '-')
+            if dest in flags:
+                if value.lower() in ['1', 'yes', 'true', 'on']:
+                    stage_args.append(option)
+                elif value.lower() not in ['0', 'no', 'false', 'off']:
+                    sys.exit("qbatch: error: invalid workflow: {0} in stage "
+                             "{1} must be true or false".format(key, name))
+                elif getattr(args, dest):
+                    sys.exit("qbatch: error: invalid workflow: stage {0} "
+                             "cannot turn off {1} given on the command "
+                             "line".format(name, option))
+                continue
+            if dest in lists:
+                setattr(stage, lists[dest], None)
+            for line in value.splitlines():
+                stage_args.append('{0}={1}'.format(option, line))
+
+        # anything not parsed as an option would be taken as a command
+        stage.command_file = []
+        try:
+            stage = parser.parse_args(stage_args, namespace=stage)
+        except SystemExit:
+            stage.command_file = None
+        if stage.command_file != []:
+            sys.exit("qbatch: error: invalid workflow: invalid options in "
+                     "stage {0}".format(name))
+        stage.command_file = shlex.split(options.get('command_file', ''))
+        if 'jobname' not in options:
+            stage.jobname = name
+        stage.depend_ids = sum((job_ids[upstream]
+                                for upstream in options['depends']), [])
+        stage.require_job_ids = name in upstreams
+        job_ids[name] = qbatchDriver(**vars(stage))
+
+
+def queue_load(system, queues):
+    """Takes a snapshot of the free capacity of each queue
+
+    On SGE this is the number of available slots (qstat -g c). On SLURM it
+    is the number of idle CPUs in each partition (sinfo) less the CPUs
+    requested by pending jobs (squeue); when no partition has any left,
+    partitions are weighted by their size relative to the CPUs allocated
+    and requested in them. PBS does not report the size of a queue, so the
+    number of jobs running in it is taken as its size, relative to the
+    number of pending jobs (qstat -x).
+
+    Returns a list of weights, one per queue, which are larger for queues
+    with more free capacity.
+
+    Raises an Exception if there is an error running the 'qstat', 'sinfo'
+    or 'squeue' command or parsing its output.
+    """
+    if system == 'sge':
+        # CLUSTER QUEUE  CQLOAD  USED  RES  AVAIL  TOTAL aoACDS  cdsuE
+        output = subprocess.check_output(['qstat', '-g', 'c']).decode('utf-8')
+        available = {}
+        for line in output.splitlines()[2:]:
+            fields = line.split()
+            if len(fields) >= 6:
+                available[fields[0]] = int(fields[4])
+        return [float(available.get(queue, 0)) for queue in queues]
+
+    pending = dict((queue, 0) for queue in queues)
+    if system == 'pbs':
+        import xml.etree.ElementTree as ET
+
+        running = dict((queue, 0) for queue in queues)
+        output = subprocess.check_output(['qstat', '-x'])
+        for job in output and ET.fromstring(output).findall('Job') or []:
+            queue = job.findtext('queue')
+            if queue not in pending:
+                continue
+            if job.findtext('job_state') == 'Q':
+                pending[queue] += 1
+            elif job.findtext('job_state') == 'R':
+                running[queue] += 1
+        return [(1.0 + running[queue]) / (1 + pending[queue])
+                for queue in queues]
+
+    # PARTITION CPUS(A/I/O/T), one line per group of nodes
+    allocated = dict((queue, 0) for queue in queues)
+    idle = dict((queue, 0) for queue in queues)
+    total = dict((queue, 0) for queue in queues)
+    output = subprocess.check_output(
+        ['sinfo', '-h', '--format=%R %C']).decode('utf-8')
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] in total:
+            cpus = [int(x) for x in fields[1].split('/')]
+            allocated[fields[0]] += cpus[0]
+            idle[fields[0]] += cpus[1]
+            total[fields[0]] += cpus[3]
+    # PARTITION(S) CPUS of each pending job
+    output = subprocess.check_output(
+        ['squeue', '-h', '--states=PD', '--format=%P %C']).decode('utf-8')
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) != 2:
+            continue
+        for partition in fields[0].split(','):
+            if partition in pending:
+                pending[partition] += int(fields[1])
+    free = [max(idle[queue] - pending[queue], 0) for queue in queues]
+    if any(free):
+        return [float(x) for x in free]
+    return [float(total[queue]) / max(allocated[queue] + pending[queue], 1)
+            for queue in queues]
+
+
+def split_chunks(num_jobs, weights):
+    """Splits a number of chunks in proportion to a list of weights
+
+    Returns a list of chunk counts, one per weight, which add up to num_jobs.
+    """
+    total = float(sum(weights))
+    if total <= 0:
+        weights = [1.0] * len(weights)
+        total = float(len(weights))
+    exact = [num_jobs * weight / total for weight in weights]
+    counts = [int(math.floor(x)) for x in exact]
+    # hand out the remaining chunks by largest remainder
+    by_remainder = sorted(range(len(weights)),
+                          key=lambda i: counts[i] - exact[i])
+    for i in by_remainder[:num_jobs - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def queue_args(system, queue, first=None, last=None):
+    """Command line arguments for qsub or sbatch which select a queue, and
+    optionally a range of array elements
+
+    Returns a list of arguments.
+    """
+    if system == 'slurm':
+        args = ['--partition={0}'.format(queue)]
+        if first:
+            args.append('--array={0}-{1}'.format(first, last))
+    else:
+        args = ['-q', queue]
+        if first:
+            args += ['-t', '{0}-{1}'.format(first, last)]
+    return args
+
+
+def index_ranges(indices):
+    """Compresses a sorted list of integers into a list of (first, last)
+    ranges of consecutive integers"""
+    ranges = []
+    for index in indices:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return [tuple(r) for r in ranges]
+
+
+def resource_args(system, mem, memvars, walltime):
+    """Command line arguments for qsub or sbatch which request memory and
+    walltime
+
+    Returns a list of arguments.
+    """
+    args = []
+    if system == 'slurm':
+        if mem:
+            args += ['--{0}={1}'.format(var, mem) for var in memvars]
+        if walltime and walltime.find(":") > 0:
+            args.append("--time={0}".format(walltime))
+        elif walltime:
+            args.append("--time={:1.0f}".format(int(walltime) / 60))
+    else:
+        if mem:
+            args += ['-l', ','.join(["{0}={1}".format(var, mem)
+                                     for var in memvars])]
+        if walltime:
+            args += ['-l', "{0}={1}".format(
+                system == 'sge' and 'h_rt' or 'walltime', walltime)]
+    return args
+
+
+def job_is_active(system, job_name):
+    """Checks whether jobs with the given name are queued or running"""
+    if system == 'pbs':
+        import xml.etree.ElementTree as ET
+
+        output = subprocess.check_output(['qstat', '-x'])
+        return any(job.findtext('Job_Name') == job_name and
+                   job.findtext('job_state') not in ['C', 'E']
+                   for job in output and ET.fromstring(output).findall('Job')
+                   or [])
+    elif system == 'sge':
+        return subprocess.call(['qstat', '-j', job_name],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0
+    output = subprocess.check_output(
+        ['squeue', '-h', '--user={}'.format(os.environ.get("USER")),
+         '--name={0}'.format(job_name), '--format=%A']).decode('utf-8')
+    return bool(output.strip())
+
+
+def retry_failed(**kwargs):
+    """Resubmits the elements of an array job which did not succeed
+
+    Array job scripts mark each element which succeeds in the script folder.
+    Any element without a mark once the job has left the queue (because its
+    commands failed, or it was killed) is resubmitted with the original
+    array script, optionally with new resource requests.
+
+    Returns a list of the submitted job IDs.
+    """
+    try:
+        __varsSet
+    except NameError:
+        _setupVars()
+    job_name = kwargs.get('retry')
+    system = kwargs.get('system')
+    script_folder = kwargs.get('script_folder', SCRIPT_FOLDER)
+    mem = kwargs.get('mem') != '0' and kwargs.get('mem') or None
+    max_retries = kwargs.get('max_retries')
+    verbose = kwargs.get('verbose')
+    dry_run = kwargs.get('dryrun')
+
+    if system not in ['pbs', 'sge', 'slurm']:
+        sys.exit("qbatch: error: --retry is only supported on PBS, SGE and "
+                 "SLURM")
+    scriptfile = os.path.join(script_folder, job_name + ".array")
+    if not os.path.isfile(scriptfile):
+        sys.exit("qbatch: error: no array job script {0}".format(scriptfile))
+    if os.path.isdir(os.path.join(script_folder, job_name + ".queue")):
+        sys.exit("qbatch: error: --retry does not support --dynamic jobs")
+
+    # the number of array elements is in the array directive of the script
+    with open(scriptfile, 'r', encoding="utf-8") as script:
+        match = re.search(r"^#(?:PBS|\$|SBATCH) (?:-t |--array=)1-(\d+)$",
+                          script.read(), re.MULTILINE)
+    if not match:
+        sys.exit("qbatch: error: cannot find the array size in "
+                 "{0}".format(scriptfile))
+    num_jobs = int(match.group(1))
+
+    try:
+        active = not dry_run and job_is_active(system, job_name)
+    except Exception as e:
+        sys.exit("qbatch: error: cannot check the queue for {0}: "
+                 "{1}".format(job_name, str(e)))
+    if active:
+        sys.exit("qbatch: error: {0} is still queued or running, retry once "
+                 "it has finished".format(job_name))
+
+    succeeded_dir = os.path.join(script_folder, job_name + ".succeeded")
+    if not os.path.isdir(succeeded_dir):
+        sys.exit("qbatch: error: no record of the elements of {0} which "
+                 "succeeded".format(job_name))
+    succeeded = set(int(name) for name in os.listdir(succeeded_dir)
+                    if name.isdigit())
+    failed = [index for index in range(1, num_jobs + 1)
+              if index not in succeeded]
+    if not failed:
+        print("qbatch: all {0} elements of {1} succeeded, nothing to "
+              "retry".format(num_jobs, job_name), file=sys.stderr)
+        return []
+
+    retries_file = os.path.join(script_folder, job_name + ".retries")
+    retries = 0
+    if os.path.isfile(retries_file):
+        with open(retries_file, 'r', encoding="utf-8") as f:
+            retries = int(f.read().strip() or 0)
+    if retries >= max_retries:
+        sys.exit("qbatch: error: {0} has already been retried {1} time(s), "
+                 "see --max-retries".format(job_name, retries))
+
+    print("qbatch: retrying {0} of {1} elements of {2}: {3}".format(
+        len(failed), num_jobs, job_name, ','.join(map(str, failed))),
+        file=sys.stderr)
+
+    submit_args = resource_args(system, mem, kwargs.get('memvars').split(','),
+                                kwargs.get('walltime'))
+    queues = kwargs.get('queue') and kwargs.get('queue').split(',') or []
+    if len(queues) > 1:
+        # resubmit to the queue with the most free capacity
+        try:
+            weights = [float(x) for x in
+                       (kwargs.get('queue_weights') or '').split(',')]
+        except ValueError:
+            weights = []
+        if len(weights) != len(queues):
+            try:
+                weights = queue_load(system, queues)
+            except Exception as e:
+                print("qbatch: warning: could not read the load on each "
+                      "queue ({0}), using {1}".format(str(e), queues[0]),
+                      file=sys.stderr)
+                weights = [1.0] * len(queues)
+        queues = [queues[weights.index(max(weights))]]
+    if queues:
+        submit_args += queue_args(system, queues[0])
+    ranges = index_ranges(failed)
+    if system == 'sge':
+        # SGE only accepts a single range of task IDs
+        array_args = [['-t', '{0}-{1}'.format(*r)] for r in ranges]
+    else:
+        array_list = ','.join(first == last and str(first) or
+                              '{0}-{1}'.format(first, last)
+                              for first, last in ranges)
+        array_args = [system == 'slurm' and
+                      ['--array={0}'.format(array_list)] or
+                      ['-t', array_list]]
+
+    submit = system == 'slurm' and 'sbatch' or 'qsub'
+    job_ids = []
+    for args in array_args:
+        command = [submit] + args + submit_args + [scriptfile]
+        if verbose:
+            print("Running: {0}".format(' '.join(command)))
+        if dry_run:
+            continue
+        returncode, output = submit_command(command)
+        if returncode:
+            sys.exit("qbatch: error: {0} call ".format(submit) +
+                     "returned error code {0}".format(returncode))
+        job_ids.append(submitted_job_id(system, output))
+
+    if not dry_run:
+        with open(retries_file, 'w', encoding="utf-8") as f:
+            f.write(u"{0}\n".format(retries + 1))
+    return job_ids
+
+
+def submit_command(command):
+    """Runs a job submission command, echoing its output as it arrives
+
+    With --block the submission command only exits once the jobs finish,
+    but reports the job ID as soon as they are submitted.
+
+    Returns a tuple of (return code, output).
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = []
+    for line in iter(process.stdout.readline, b''):
+        line = line.decode('utf-8')
+        print(line, end='', flush=True)
+        output.append(line)
+    process.stdout.close()
+    return process.wait(), ''.join(output)
+
+
 def which(program):
     # Check for existence of important programs
     # Stolen from
@@ -348,11 +1404,61 @@ def qbatchDriver(**kwargs):
     shell = kwargs.get('shell')
     block = kwargs.get('block')
     script_folder = kwargs.get('script_folder', SCRIPT_FOLDER)
+    stage_in = kwargs.get('stage_in')
+    stage_out = kwargs.get('stage_out')
+    stage_regex = kwargs.get('stage_in_regex')
+    staging = stage_in or stage_out or stage_regex
+    micro = kwargs.get('micro')
+    depend_ids = kwargs.get('depend_ids') or []
+    require_job_ids = kwargs.get('require_job_ids')
+    pin = kwargs.get('pin')
+    if pin and micro:
+        sys.exit("qbatch: error: --pin cannot be used with --micro")
+    dynamic = kwargs.get('dynamic')
+    if (stage_in or stage_regex) and not stage_out:
+        print("qbatch: warning: commands run in node-local scratch, which is "
+              "deleted when they finish; without --stage-out only outputs "
+              "written to absolute paths are kept", file=sys.stderr)
+    if dynamic and (micro or pin or staging):
+        sys.exit("qbatch: error: --dynamic cannot be used with --micro, "
+                 "--pin or staging")
+    queues = queue and queue.split(',') or []
+    if len(queues) > 1:
+        # each submission picks its own queue
+        queue = None
+    group_by = kwargs.get('group_by')
+    dedup = kwargs.get('dedup')
+    skip_completed = kwargs.get('skip_completed')
+    use_auto_resources = kwargs.get('auto_resources')
+    joblog_dir = ((skip_completed or use_auto_resources) and
+                  os.path.abspath(os.path.join(script_folder, 'joblogs')))
 
     mkdirp(logdir)
 
     # read in commands
-    if not kwargs.get('task_list'):
+    template = kwargs.get('template')
+    sweep = kwargs.get('sweep')
+    link = kwargs.get('link')
+    if template:
+        if not sweep:
+            sys.exit("qbatch: error: --template needs --args or --args-file")
+        if (dedup or skip_completed or group_by or dynamic or
+                system == 'container'):
+            sys.exit("qbatch: error: --template cannot be used with --dedup, "
+                     "--skip-completed, --group-by, --dynamic or the "
+                     "container system")
+        if not re.search(r"\{[0-9]*\}", template):
+            template += ''.join(' {{{0}}}'.format(i + 1)
+                                for i in range(len(sweep)))
+        # commands are expanded in the job scripts, one chunk at a time
+        task_list = []
+        num_tasks = sweep_size(sweep, link)
+        sweep_data = '\n'.join(
+            ['0\t' + template] +
+            ['{0}\t{1}'.format(i + 1, value)
+             for i, values in enumerate(sweep) for value in values])
+        job_name = job_name or 'sweep'
+    elif not kwargs.get('task_list'):
         if command_file[0] == '--':
             if (len(command_file) > 1):
                 task_list = [" ".join(command_file[1:])]
@@ -382,24 +1488,113 @@ def qbatchDriver(**kwargs):
     # Drop commented out lines
     task_list[:] = [x for x in task_list if not x.startswith('#')]
 
+    # Drop duplicate commands
+    if dedup:
+        num_read = len(task_list)
+        task_list[:] = unique_commands(task_list)
+        print("qbatch: removed {0} duplicate command(s)".format(
+            num_read - len(task_list)), file=sys.stderr)
+
+    # Drop commands which succeeded in previous runs
+    if skip_completed:
+        completed = completed_commands(joblog_dir)
+        num_read = len(task_list)
+        task_list[:] = [x for x in task_list
+                        if command_hash(x) not in completed]
+        print("qbatch: skipping {0} previously completed command(s)".format(
+            num_read - len(task_list)), file=sys.stderr)
+
+    # Place commands sharing an input next to each other
+    if group_by:
+        try:
+            keys = command_keys(task_list, group_by)
+        except re.error as e:
+            sys.exit("qbatch: error: invalid --group-by expression: "
+                     "{0}".format(str(e)))
+        ungrouped_keys = keys
+        # chunks only bound the commands run together by a static array job
+        pack_size = (system != 'local' and not dynamic and chunk_size or
+                     None)
+        task_list[:], keys = group_commands(task_list, keys, pack_size)
+
+    if not template:
+        num_tasks = len(task_list)
+
+    # staging copies paths relative to the working directory; commands keep
+    # reading absolute paths from shared storage
+    absolute = [path for path in stage_in or [] if os.path.isabs(path)]
+    if stage_regex:
+        try:
+            regex = re.compile(stage_regex)
+            absolute += [match.group(0) for command in task_list
+                         for match in regex.finditer(command)
+                         if os.path.isabs(match.group(0))]
+        except re.error:
+            pass
+    if absolute:
+        print("qbatch: warning: absolute paths are not staged in, "
+              "e.g. {0}".format(absolute[0]), file=sys.stderr)
+
     # compute the number of jobs needed. This will be the number of elements in
     # the array job
-    if len(task_list) == 0:
+    if num_tasks == 0:
         print("qbatch: warning: No jobs to submit, exiting", file=sys.stderr)
-        sys.exit()
+        return []
 
     if system == 'local' or chunk_size == 0:
         use_array = False
         num_jobs = 1
         chunk_size = sys.maxsize
-    elif len(task_list) <= chunk_size:
+    elif num_tasks <= chunk_size:
         use_array = False
         num_jobs = 1
         if verbose:
             print("Number of commands less than chunk size, "
                   "building single non-array job", file=sys.stderr)
     else:
-        num_jobs = int(math.ceil(len(task_list) / float(chunk_size)))
+        num_jobs = int(math.ceil(num_tasks / float(chunk_size)))
+
+    # report the reads of shared inputs saved by grouping
+    if group_by:
+        before = chunk_reads(ungrouped_keys, chunk_size)
+        after = chunk_reads(keys, chunk_size)
+        saved_bytes = sum(
+            (before[key] - after[key]) *
+            os.path.getsize(os.path.join(workdir, key))
+            for key in after if os.path.isfile(os.path.join(workdir, key)))
+        print("qbatch: grouping {0} shared input(s) reduces the number of "
+              "times they are read from {1} to {2}".format(
+                  len(after), sum(before.values()), sum(after.values())) +
+              (saved_bytes and ", saving {0:.1f} MiB of reads".format(
+                  saved_bytes / 1048576.0) or ''),
+              file=sys.stderr)
+
+    # the number of commands each job runs at once
+    if ncores[-1] == '%':
+        concurrency = int(math.floor(ppj * float(ncores.strip('%')) / 100))
+    else:
+        concurrency = int(ncores)
+
+    # size the resource requests from previous runs of this job
+    if use_auto_resources and system in ['pbs', 'sge', 'slurm']:
+        auto_mem, auto_walltime = auto_resources(
+            joblog_dir, job_name, system, num_tasks, chunk_size,
+            concurrency, kwargs.get('auto_percentile'),
+            kwargs.get('auto_margin'))
+        if auto_mem or auto_walltime:
+            mem = auto_mem or mem
+            walltime = auto_walltime or walltime
+            print("qbatch: auto-resources: mem={0} walltime={1}".format(
+                mem, walltime), file=sys.stderr)
+        else:
+            print("qbatch: auto-resources: no usage recorded for {0} yet, "
+                  "using the requested resources".format(job_name),
+                  file=sys.stderr)
+
+    if dynamic and not use_array:
+        print("qbatch: warning: --dynamic only applies to array jobs, "
+              "ignoring it", file=sys.stderr)
+        dynamic = False
 
     # copy the current environment
     env = ''
@@ -419,6 +1614,8 @@ def qbatchDriver(**kwargs):
             sys.exit(
                 "qbatch: error: Error matching"
                 " depend pattern {0}".format(str(e)))
+        matching_array_jobids += [x for x in depend_ids if '[]' in x]
+        matching_regular_jobids += [x for x in depend_ids if '[]' not in x]
 
         if (matching_array_jobids and matching_regular_jobids):
             print("qbatch: warning: depdendencies on both regular and"
@@ -450,8 +1647,9 @@ def qbatchDriver(**kwargs):
         ppj = (ppj > 1) and '-pe {0} {1}'.format(sge_pe, ppj) or ''
         o_array = use_array and '-t 1-{0}'.format(num_jobs) or ''
         o_walltime = walltime and "-l h_rt={0}".format(walltime) or ''
-        o_dependencies = depend_pattern and '-hold_jid \'' + \
-            '\',\''.join(depend_pattern) + '\'' or ''
+        hold_jids = (depend_pattern or []) + depend_ids
+        o_dependencies = hold_jids and '-hold_jid \'' + \
+            '\',\''.join(hold_jids) + '\'' or ''
         o_options = '\n#$ '.join(options)
         mem_string = ','.join(["{0}={1}".format(var, mem) for var in memvars])
         o_memopts = (mem and mem_string) and '-l {0}'.format(mem_string) or ''
@@ -476,6 +1674,7 @@ def qbatchDriver(**kwargs):
                 depend_pattern)
         except Exception as e:
             sys.exit("Error matching depend pattern {0}".format(str(e)))
+        matching_regular_jobids += depend_ids
         o_dependencies = '{0}'.format(
             '--dependency=afterok:' + ':'.join(matching_regular_jobids)
             if (matching_regular_jobids) else '')
@@ -500,6 +1699,25 @@ def qbatchDriver(**kwargs):
     # emit job scripts
     job_scripts = []
     mkdirp(script_folder)
+    if joblog_dir:
+        mkdirp(joblog_dir)
+    # forget the retries and queue of earlier submissions under this job
+    # name
+    succeeded_dir = os.path.abspath(
+        os.path.join(script_folder, job_name + ".succeeded"))
+    shutil.rmtree(succeeded_dir, ignore_errors=True)
+    shutil.rmtree(os.path.join(script_folder, job_name + ".queue"),
+                  ignore_errors=True)
+    retries_file = os.path.join(script_folder, job_name + ".retries")
+    if os.path.isfile(retries_file):
+        os.remove(retries_file)
+    pin_shell = None
+    if pin and system != "container":
+        pin_shell = os.path.abspath(
+            os.path.join(script_folder, job_name + ".pin"))
+        with open(pin_shell, 'w', encoding="utf-8") as script:
+            script.write(PIN_SHELL_TEMPLATE.format(shell=shlex.quote(shell)))
+        os.chmod(pin_shell, os.stat(pin_shell).st_mode | stat.S_IXUSR)
     if system == "container":
         script_lines = [
             ''.join(task_list)
@@ -514,21 +1732,72 @@ def qbatchDriver(**kwargs):
         meta.close()
     else:
         if use_array:
-            script_lines = [
-                header,
-                'command -v parallel > /dev/null 2>&1 || { echo "GNU parallel '
-                'not found in job environment. Exiting."; exit 1; }',
+            prelude, runner = chunk_runner(
+                job_name, '${ARRAY_IND}', joblog_dir=joblog_dir,
+                record_usage=use_auto_resources, micro=micro,
+                pin_shell=pin_shell, dynamic=dynamic)
+            script_lines = [header] + prelude + [
                 'CHUNK_SIZE={0}'.format(chunk_size),
                 'CORES={0}'.format(ncores),
                 'export THREADS_PER_COMMAND={0}'.format(
                     compute_threads(
                         kwargs.get('ppj'),
-                        ncores)),
-                'sed -n "$(( (${ARRAY_IND} - 1) * ${CHUNK_SIZE} + 1 )),'
-                '+$(( ${CHUNK_SIZE} - 1 ))p" << \'EOF\' | parallel -j${CORES}'
-                ' --tag --line-buffer --compress',
-                ''.join(task_list),
-                'EOF']
+                        ncores))]
+
+            if dynamic:
+                # every element takes commands from the shared queue until
+                # it is empty
+                queue_dir = os.path.abspath(
+                    os.path.join(script_folder, job_name + ".queue"))
+                commands = [x.rstrip('\n') + '\n' for x in task_list
+                            if x.strip()]
+                # claim blocks of commands, about four per parallel slot,
+                # so each block file is read once and the lock is taken
+                # once per block
+                block_size = max(1, len(commands) //
+                                 (4 * num_jobs * max(concurrency, 1)))
+                num_blocks = int(math.ceil(len(commands) /
+                                           float(block_size)))
+                if os.path.isfile(queue_dir):
+                    os.remove(queue_dir)
+                shutil.rmtree(queue_dir, ignore_errors=True)
+                mkdirp(queue_dir)
+                for block in range(num_blocks):
+                    with open(os.path.join(queue_dir, str(block + 1)), 'w',
+                              encoding="utf-8") as block_file:
+                        block_file.write(''.join(commands[
+                            block * block_size:(block + 1) * block_size]))
+                with open(queue_dir + ".claimed", 'w',
+                          encoding="utf-8") as claimed:
+                    claimed.write(u"0\n")
+                shutil.rmtree(queue_dir + ".lock", ignore_errors=True)
+                script_lines += [
+                    'QBATCH_QUEUE="{0}"'.format(queue_dir),
+                    'QBATCH_QUEUE_BLOCKS={0}'.format(num_blocks),
+                    'QBATCH_BLOCK_SIZE={0}'.format(block_size),
+                    runner]
+            else:
+                if template:
+                    commands = sweep_data
+                    source = sweep_source(
+                        '"$(( (${ARRAY_IND} - 1) * ${CHUNK_SIZE} + 1 ))"',
+                        '${CHUNK_SIZE}', link)
+                else:
+                    commands = ''.join(task_list)
+                    source = ('sed -n "$(( (${ARRAY_IND} - 1) * ${CHUNK_SIZE}'
+                              ' + 1 )),+$(( ${CHUNK_SIZE} - 1 ))p"')
+                script_lines += chunk_lines(
+                    commands, runner, source=source,
+                    workdir=workdir, stage_in=stage_in, stage_out=stage_out,
+                    stage_regex=stage_regex)
+
+                # mark the array elements which succeed, for --retry
+                mkdirp(succeeded_dir)
+                script_lines += [
+                    'QBATCH_RC=$?',
+                    '[ $QBATCH_RC -eq 0 ] && : > "{0}/${{ARRAY_IND}}"'.format(
+                        succeeded_dir),
+                    '(exit $QBATCH_RC)']
 
             scriptfile = os.path.join(script_folder, job_name + ".array")
             script = open(scriptfile, 'w', encoding="utf-8")
@@ -542,26 +1811,35 @@ def qbatchDriver(**kwargs):
             for chunk in range(num_jobs):
                 scriptfile = os.path.join(
                     script_folder, "{0}.{1}".format(job_name, chunk))
-                if len(task_list) == 1:
+                if (len(task_list) == 1 and
+                        not (joblog_dir or staging or template)):
                     script_lines = [
                         header,
                         'export THREADS_PER_COMMAND={0}'.format(
                             compute_threads(kwargs.get('ppj'), ncores)),
                         ''.join(task_list)]
                 else:
-                    script_lines = [
-                        header,
-                        'command -v parallel > /dev/null 2>&1 || { echo "GNU'
-                        ' parallel not found in job environment. Exiting.";'
-                        ' exit 1; }',
+                    prelude, runner = chunk_runner(
+                        job_name, chunk + 1, joblog_dir=joblog_dir,
+                        record_usage=use_auto_resources, micro=micro,
+                        pin_shell=pin_shell)
+                    script_lines = [header] + prelude + [
                         'CORES={0}'.format(ncores),
                         'export THREADS_PER_COMMAND={0}'.format(
-                            compute_threads(kwargs.get('ppj'), ncores)),
-                        "parallel -j${CORES} --tag --line-buffer"
-                        " --compress << \'EOF\'",
-                        ''.join(task_list[chunk * chunk_size:chunk *
-                                          chunk_size + chunk_size]),
-                        'EOF']
+                            compute_threads(kwargs.get('ppj'), ncores))]
+                    if template:
+                        commands = sweep_data
+                        source = sweep_source(
+                            chunk * chunk_size + 1,
+                            min(chunk_size, num_tasks), link)
+                    else:
+                        commands = ''.join(task_list[chunk * chunk_size:chunk *
+                                                     chunk_size + chunk_size])
+                        source = None
+                    script_lines += chunk_lines(
+                        commands, runner, source=source, workdir=workdir,
+                        stage_in=stage_in, stage_out=stage_out,
+                        stage_regex=stage_regex)
                 script = open(scriptfile, 'w', encoding="utf-8")
                 script.write('\n'.join(script_lines))
                 if footer_commands:
@@ -582,29 +1860,73 @@ def qbatchDriver(**kwargs):
         which('qstat') or sys.exit("qbatch: error: QBATCH_SYSTEM set to"
                                    " pbs/sge but qstat not found")
 
-    which('parallel') or sys.exit("qbatch: error: gnu-parallel not found")
+    micro or dynamic or which('parallel') or sys.exit(
+        "qbatch: error: gnu-parallel not found")
+
+    # spread the chunks over the queues
+    submissions = [(script, []) for script in job_scripts]
+    if len(queues) > 1 and system in ['pbs', 'sge', 'slurm']:
+        if kwargs.get('queue_weights'):
+            try:
+                weights = [float(x) for x in
+                           kwargs.get('queue_weights').split(',')]
+            except ValueError:
+                weights = []
+            if len(weights) != len(queues):
+                sys.exit("qbatch: error: --queue-weights must give a number "
+                         "for each queue")
+        else:
+            try:
+                weights = queue_load(system, queues)
+            except Exception as e:
+                print("qbatch: warning: could not read the load on each "
+                      "queue ({0}), splitting jobs evenly".format(str(e)),
+                      file=sys.stderr)
+                weights = [1.0] * len(queues)
+        counts = split_chunks(num_jobs, weights)
+        print("qbatch: distributing {0} chunk(s): {1}".format(
+            num_jobs, ', '.join("{0}={1}".format(q, count) for q, count
+                                in zip(queues, counts))), file=sys.stderr)
+        if use_array:
+            submissions = []
+            first = 1
+            for q, count in zip(queues, counts):
+                if count:
+                    submissions.append((job_scripts[0], queue_args(
+                        system, q, first, first + count - 1)))
+                    first += count
+        else:
+            chunk_queues = [q for q, count in zip(queues, counts)
+                            for _ in range(count)]
+            submissions = [(script, queue_args(system, q)) for script, q
+                           in zip(job_scripts, chunk_queues)]
 
     # execute the job script(s)
-    for script in job_scripts:
+    job_ids = []
+    for script, submit_args in submissions:
         os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
-        if system == 'sge' or system == 'pbs':
-            if verbose:
-                print("Running: qsub {0}".format(script))
-            if dry_run:
-                continue
-            return_code = subprocess.call(['qsub', script])
-            if return_code:
-                sys.exit("qbatch: error: qsub call " +
-                         "returned error code {0}".format(return_code))
-        elif system == 'slurm':
+        if system == 'sge' or system == 'pbs' or system == 'slurm':
+            submit = system == 'slurm' and 'sbatch' or 'qsub'
             if verbose:
-                print("Running: sbatch {0}".format(script))
+                print("Running: {0} {1}".format(
+                    submit, ' '.join(submit_args + [script])))
             if dry_run:
                 continue
-            return_code = subprocess.call(['sbatch', script])
-            if return_code:
-                sys.exit("qbatch: error: sbatch call " +
-                         "returned error code {0}".format(return_code))
+            returncode, output = submit_command(
+                [submit] + submit_args + [script])
+            if returncode:
+                sys.exit("qbatch: error: {0} call ".format(submit) +
+                         "returned error code {0}".format(returncode))
+            job_id = submitted_job_id(system, output)
+            if job_id:
+                job_ids.append(job_id)
+            elif require_job_ids:
+                sys.exit("qbatch: error: could not find the job ID in the "
+                         "{0} output, which the stages depending on "
+                         "{1} need".format(submit, job_name))
+            else:
+                print("qbatch: warning: could not find the job ID in the "
+                      "{0} output".format(submit), file=sys.stderr)
         elif system == 'local':
             logfile = "{0}/{1}.log".format(logdir, job_name)
             if verbose:
@@ -615,6 +1937,7 @@ def qbatchDriver(**kwargs):
             if return_code:
                 sys.exit("qbatch: error: local run call " +
                          "returned error code {0}".format(return_code))
+    return job_ids
 
 
 def qbatchParser(args=None):
@@ -662,7 +1985,9 @@ def qbatchParser(args=None):
         requirement, set this to 0""")
     parser.add_argument(
         "-q", "--queue", default=QUEUE,
-        help="""Name of queue to submit jobs to (defaults to no queue)""")
+        help="""Name of queue to submit jobs to (defaults to no queue). A
+        comma-separated list of queues spreads the jobs over the queues
+        according to their load, or --queue-weights""")
 
     parser.add_argument(
         "-n", "--dryrun", action="store_true",
@@ -742,9 +2067,132 @@ def qbatchParser(args=None):
     group.add_argument(
         "--script-folder", default=SCRIPT_FOLDER,
         help="""Directory where job scripts are stored""")
+    group.add_argument(
+        "--retry", metavar="JOBNAME",
+        help="""Resubmit only the elements of the finished array job
+        JOBNAME which did not succeed, using its existing job script. The
+        --mem, --walltime and --queue options given with --retry replace
+        the original requests""")
+    group.add_argument(
+        "--max-retries", default=3, type=int,
+        help="""Number of times --retry may resubmit an array job""")
+    group.add_argument(
+        "--queue-weights", metavar="WEIGHTS",
+        help="""A comma-separated list of relative weights used to spread
+        jobs over the queues given with -q (e.g. -q short,long
+        --queue-weights 3,1). By default the weights come from the free
+        capacity of each queue: its idle CPUs less those requested by
+        pending jobs (SLURM), its available slots (SGE), or its running
+        relative to its pending jobs (PBS)""")
+    group.add_argument(
+        "--workflow", metavar="FILE",
+        help="""Submit the stages described in an INI file instead of a
+        command file. Each [stage] section sets its command_file (or
+        template), the stages it depends on (depends = stage1, stage2) and
+        any other long options for the stage (e.g. mem = 4G, or individual =
+        true; a stage cannot turn off a flag given on the command line).
+        Stages wait on the job IDs returned when their upstream stages were
+        submitted""")
+    group.add_argument(
+        "--template", metavar="CMD",
+        help="""Run a parameter sweep instead of a command file: the
+        commands are CMD with {1}, {2}, ... (or {}) replaced by a value from
+        the first, second, ... list of values given with --args or
+        --args-file. When CMD has no placeholders the values are appended.
+        Only the template and values are written to the job scripts, and
+        each job expands just its own chunk of commands""")
+    group.add_argument(
+        "--args", dest="sweep", action="append", type=sweep_values,
+        metavar="VALUES",
+        help="""A space-separated list of values for --template (e.g.
+        --args "0.1 0.2 0.5"). This option can be given multiple times, once
+        per placeholder""")
+    group.add_argument(
+        "--args-file", dest="sweep", action="append", type=sweep_file,
+        metavar="FILE",
+        help="""A file of values for --template, one per line. This option
+        can be given multiple times and mixed with --args""")
+    group.add_argument(
+        "--link", action="store_true",
+        help="""Pair the values of the --args lists by position instead of
+        running every combination of them, recycling the values of shorter
+        lists""")
+    group.add_argument(
+        "--dynamic", action="store_true",
+        help="""Instead of running a fixed chunk of commands, each array
+        job element runs CORES persistent shells which take the next
+        unclaimed block of commands from a queue shared by all elements in
+        the script folder, until it is empty. This balances the load when
+        command runtimes vary. As with --micro, GNU parallel is not used:
+        commands are run with eval by the shells, and output is tagged with
+        each command once it finishes""")
+    group.add_argument(
+        "--pin", action="store_true",
+        help="""Pin each of the commands running in parallel in a job to
+        its own set of THREADS_PER_COMMAND CPUs, chosen from the CPUs
+        allocated to the job in NUMA node order (needs taskset)""")
+    group.add_argument(
+        "--micro", action="store_true",
+        help="""Run the commands of each job in CORES persistent shells
+        instead of GNU parallel, avoiding the overhead of starting parallel
+        and a shell for every command. Suited to very short commands. Output
+        is tagged with each command once it finishes. Runtimes and memory
+        use are not recorded for --auto-resources""")
+    group.add_argument(
+        "--stage-in", action="append", metavar="PATH",
+        help="""A file or directory (relative to the working directory,
+        glob patterns allowed) to copy to node-local scratch ($TMPDIR) once
+        per job. Commands then run from the scratch directory. This option
+        can be given multiple times""")
+    group.add_argument(
+        "--stage-in-regex", metavar="REGEX",
+        help="""An extended regular expression (as used by grep -E)
+        matching the relative input paths in the commands of a job, which
+        are staged in as with --stage-in. Absolute paths are left on shared
+        storage""")
+    group.add_argument(
+        "--stage-out", action="append", metavar="PATH",
+        help="""A file or directory (relative to the scratch directory,
+        glob patterns allowed) to copy back to the working directory after
+        the commands of a job finish. Other outputs are deleted with the
+        scratch directory. This option can be given multiple times""")
+    group.add_argument(
+        "--auto-resources", action="store_true",
+        help="""Record the runtime and peak memory of commands, and set
+        --mem and --walltime for each job from the usage recorded by
+        previous runs of the same job name (PBS, SGE and SLURM only)""")
+    group.add_argument(
+        "--auto-percentile", default=95, type=float,
+        help="""Percentile of the recorded per-command usage to size jobs
+        with when using --auto-resources""")
+    group.add_argument(
+        "--auto-margin", default=20, type=float,
+        help="""Extra margin, as a percentage, added to the resources
+        computed by --auto-resources""")
+    group.add_argument(
+        "--group-by", metavar="REGEX",
+        help="""Regular expression matching the shared input of each
+        command (e.g. the subject ID). Commands with the same match, or
+        first group of the match, are placed next to each other and packed
+        into chunks so they run in the same chunk. Only groups larger than
+        the chunk size are split across chunks""")
+    group.add_argument(
+        "--dedup", action="store_true",
+        help="""Remove duplicate commands from the command list, keeping
+        the first occurrence of each""")
+    group.add_argument(
+        "--skip-completed", action="store_true",
+        help="""Record the commands which succeed in the script folder, and
+        skip commands which succeeded in previous runs with this option""")
 
     args = parser.parse_args(args)
-    if not args.command_file:
+    if args.retry:
+        retry_failed(**vars(args))
+        return
+    if args.workflow:
+        submit_workflow(parser, args)
+        return
+    if not (args.command_file or args.template):
         parser.print_usage()
         sys.exit("qbatch: error: no command file or command provided")
     qbatchDriver(**vars(args))
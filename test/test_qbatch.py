@@ -3,7 +3,7 @@
 import os
 import shutil
 import shlex
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE, STDOUT, check_output
 import tempfile
 
 tempdir = None
@@ -28,6 +28,25 @@ def command_pipe(command):
     return Popen(shlex.split(command), stdin=PIPE, stdout=PIPE, stderr=STDOUT, env=myenv)
 
 
+# records the arguments of each submission, numbering the jobs
+FAKE_SBATCH = ('echo "$@" >> {0}/submitted\n'
+               'echo "Submitted batch job $(wc -l < {0}/submitted)"\n')
+
+
+def fake_scheduler(workdir, **scripts):
+    """Writes fake scheduler commands to workdir, each given as the body of
+    a shell script in which {0} is replaced by workdir
+
+    Returns an environment which finds them first on the PATH.
+    """
+    for name, script in scripts.items():
+        path = os.path.join(workdir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + script.format(workdir))
+        os.chmod(path, 0o755)
+    return dict(myenv, PATH=workdir + os.pathsep + myenv['PATH'])
+
+
 def test_qbatch_help():
     p = command_pipe('qbatch --help')
     out, _ = p.communicate(''.encode('utf-8'))
@@ -186,3 +205,461 @@ def test_run_qbatch_local_piped_commands_utf8():
         "Return code = {0}".format(p.returncode)
     assert set(out.splitlines()) == set(expected.splitlines()), \
         "Expected {0} but got {1}".format(expected, out)
+
+
+def test_run_qbatch_dryrun_skip_completed():
+    joblog_dir = os.path.join(tempdir, 'joblogs')
+    os.makedirs(joblog_dir, exist_ok=True)
+    with open(os.path.join(joblog_dir, 'previous.1.joblog'), 'w') as joblog:
+        joblog.write('1\thost\t0\t1\t0\t0\t0\t0\techo 1\n')
+        joblog.write('2\thost\t0\t1\t0\t0\t1\t0\techo 2\n')
+
+    job_name = 'test_run_qbatch_dryrun_skip_completed'
+    cmds = "\n".join(['echo {0}'.format(x) for x in range(4)])
+    p = command_pipe('qbatch -N {0} --env none -n -b slurm -c 2 \
+                     --skip-completed -'.format(job_name))
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    array_script = os.path.join(tempdir, job_name + '.array')
+    assert p.returncode == 0, out
+    with open(array_script) as script:
+        lines = script.read().splitlines()
+    assert 'echo 1' not in lines
+    assert 'echo 0' in lines and 'echo 2' in lines and 'echo 3' in lines
+    assert '#SBATCH --array=1-2' in lines
+
+
+def test_run_qbatch_dryrun_dedup():
+    cmds = "\n".join(['echo 0', 'echo 1', 'echo 0', 'echo 2', 'echo 1'])
+    p = command_pipe('qbatch -N test_run_qbatch_dryrun_dedup --env none -n \
+                     -b slurm -c 2 --dedup -')
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    array_script = os.path.join(tempdir, 'test_run_qbatch_dryrun_dedup.array')
+    assert p.returncode == 0, out
+    assert b'removed 2 duplicate' in out
+    with open(array_script) as script:
+        lines = script.read().splitlines()
+    start = lines.index('echo 0')
+    assert lines[start:start + 3] == ['echo 0', 'echo 1', 'echo 2']
+    assert '#SBATCH --array=1-2' in lines
+
+
+def test_run_qbatch_dryrun_auto_resources():
+    joblog_dir = os.path.join(tempdir, 'joblogs')
+    os.makedirs(joblog_dir, exist_ok=True)
+    job_name = 'test_run_qbatch_dryrun_auto_resources'
+    with open(os.path.join(joblog_dir, job_name + '.1.joblog'), 'w') as joblog:
+        joblog.write('1\thost\t0\t100.0\t0\t0\t0\t0\techo 1\n')
+        joblog.write('2\thost\t0\t9000.0\t0\t0\t1\t0\techo 2\n')
+    with open(os.path.join(joblog_dir, job_name + '.1.maxrss'), 'w') as maxrss:
+        maxrss.write('102400\n')
+
+    cmds = "\n".join(['echo {0}'.format(x) for x in range(8)])
+    p = command_pipe('qbatch -N {0} --env none -n -b slurm -c 4 -j 2 \
+                     --auto-resources -'.format(job_name))
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    array_script = os.path.join(tempdir, job_name + '.array')
+    assert p.returncode == 0, out
+    with open(array_script) as script:
+        lines = script.read().splitlines()
+    assert '#SBATCH --mem=240M' in lines
+    assert '#SBATCH --time=0:04:00' in lines
+
+
+def test_run_qbatch_dryrun_group_by():
+    cmds = "\n".join(['process sub-{0} step{1}'.format(subject, step)
+                      for step in range(2) for subject in range(3)] +
+                     ['process sub-1 step2'])
+    p = command_pipe('qbatch -N test_run_qbatch_dryrun_group_by --env none -n \
+                     -b slurm -c 2 --group-by "sub-[0-9]+" -')
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    array_script = os.path.join(tempdir,
+                                'test_run_qbatch_dryrun_group_by.array')
+    assert p.returncode == 0, out
+    assert b'from 7 to 4' in out
+    with open(array_script) as script:
+        lines = script.read().splitlines()
+    assert '#SBATCH --array=1-4' in lines
+    # sub-1 is larger than a chunk, sub-2 fits in one and starts a new chunk
+    start = lines.index('process sub-0 step0')
+    chunks = [lines[i:i + 2] for i in range(start, start + 8, 2)]
+    assert chunks == [
+        ['process sub-0 step0', 'process sub-0 step1'],
+        ['process sub-1 step0', 'process sub-1 step1'],
+        ['process sub-1 step2', ':'],
+        ['process sub-2 step0', 'process sub-2 step1']]
+
+
+def test_run_qbatch_slurm_dryrun_array_staging():
+    workdir = tempfile.mkdtemp(dir=tempdir)
+    os.mkdir(os.path.join(workdir, 'inputs'))
+    for x in range(2):
+        with open(os.path.join(workdir, 'inputs',
+                               '{0}.txt'.format(x)), 'w') as f:
+            f.write('input {0}\n'.format(x))
+
+    job_name = 'test_run_qbatch_slurm_dryrun_array_staging'
+    cmds = "\n".join(['cat inputs/{0}.txt > output_{0}.txt'.format(x)
+                      for x in range(2)])
+    p = command_pipe('qbatch -N {0} --env none -n -b slurm -c 1 -d {1} \
+                     --stage-in-regex "inputs/[0-9]+\\.txt" \
+                     --stage-out "output_*" -'.format(job_name, workdir))
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    array_script = os.path.join(tempdir, job_name + '.array')
+    assert p.returncode == 0, out
+
+    for chunk in range(1, 3):
+        myenv['SLURM_ARRAY_TASK_ID'] = str(chunk)
+        array_pipe = Popen([array_script], cwd=workdir, stdout=PIPE,
+                           stderr=STDOUT, env=myenv)
+        out, _ = array_pipe.communicate()
+
+        assert array_pipe.returncode == 0, out
+        output = os.path.join(workdir, 'output_{0}.txt'.format(chunk - 1))
+        with open(output) as f:
+            assert f.read() == 'input {0}\n'.format(chunk - 1)
+
+
+def test_run_qbatch_dryrun_staging_warnings():
+    cmds = "\n".join(['process inputs/{0}.txt /shared/{0}.txt'.format(x)
+                      for x in range(2)])
+    p = command_pipe('qbatch -N test_run_qbatch_dryrun_staging_warnings \
+                     --env none -n -b slurm -c 1 \
+                     --stage-in-regex "[^ ]*[0-9]\\.txt" -')
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    assert p.returncode == 0, out
+    assert b'without --stage-out' in out
+    assert b'absolute paths are not staged in, e.g. /shared/0.txt' in out
+
+
+def test_run_qbatch_slurm_dryrun_array_micro():
+    chunk_size = 10
+    chunks = 3
+    outputs = list(range(chunk_size * chunks))
+
+    job_name = 'test_run_qbatch_slurm_dryrun_array_micro'
+    cmds = "\n".join(['echo {0}'.format(x) for x in outputs] + ['exit 3'])
+    p = command_pipe('qbatch -N {0} --env none -n -j3 -b slurm -c {1} \
+                     --micro -'.format(job_name, chunk_size))
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    array_script = os.path.join(tempdir, job_name + '.array')
+    assert p.returncode == 0, out
+
+    for chunk in range(1, chunks + 1):
+        myenv['SLURM_ARRAY_TASK_ID'] = str(chunk)
+        expected = ['echo {0}\t{0}'.format(x) for x in outputs[(
+            chunk - 1) * chunk_size:chunk * chunk_size]]
+        array_pipe = Popen([array_script], stdout=PIPE, env=myenv)
+        out, _ = array_pipe.communicate()
+
+        assert array_pipe.returncode == 0, \
+            "Chunk {0}: return code = {1}".format(chunk, array_pipe.returncode)
+        assert set(out.decode().splitlines()) == set(expected), \
+            "Chunk {0}: Expected {1} but got {2}".format(chunk, expected, out)
+
+    myenv['SLURM_ARRAY_TASK_ID'] = str(chunks + 1)
+    array_pipe = Popen([array_script], stdout=PIPE, stderr=PIPE, env=myenv)
+    out, err = array_pipe.communicate()
+    assert array_pipe.returncode == 1
+    assert b'exit status 3: exit 3' in err
+
+
+def test_run_qbatch_slurm_workflow_depends_on_job_ids():
+    workdir = tempfile.mkdtemp(dir=tempdir)
+    env = fake_scheduler(workdir, sbatch=FAKE_SBATCH)
+    for stage in ['align', 'stats']:
+        with open(os.path.join(workdir, stage + '.txt'), 'w') as f:
+            f.write('echo {0} 1\necho {0} 2\n'.format(stage))
+    with open(os.path.join(workdir, 'workflow.ini'), 'w') as f:
+        f.write('[stats]\ncommand_file = stats.txt\ndepends = align\n'
+                'chunksize = 2\nmem = 2G\n\n'
+                '[align]\ncommand_file = align.txt\nchunksize = 1\n')
+
+    p = Popen(shlex.split('qbatch --env none -b slurm --workflow '
+                          'workflow.ini'),
+              cwd=workdir, stdout=PIPE, stderr=STDOUT, env=env)
+    out, _ = p.communicate()
+
+    assert p.returncode == 0, out
+    assert b'Submitted batch job 2' in out
+    with open(os.path.join(tempdir, 'align.array')) as script:
+        assert '#SBATCH --array=1-2' in script.read().splitlines()
+    with open(os.path.join(tempdir, 'stats.0')) as script:
+        lines = script.read().splitlines()
+    assert '#SBATCH --dependency=afterok:1' in lines
+    assert '#SBATCH --mem=2G' in lines
+
+    # unknown options, and flags turned off by a stage, are rejected
+    for stage, extra in [('sweep = 1 2', ''), ('individual = false', ' -i')]:
+        with open(os.path.join(workdir, 'bad.ini'), 'w') as f:
+            f.write('[align]\ncommand_file = align.txt\n' + stage + '\n')
+        p = Popen(shlex.split('qbatch --env none -b slurm --workflow bad.ini'
+                              + extra),
+                  cwd=workdir, stdout=PIPE, stderr=STDOUT, env=env)
+        out, _ = p.communicate()
+        assert p.returncode != 0
+        assert b'invalid workflow' in out, out
+
+
+def test_run_qbatch_slurm_workflow_sweep_stage_and_missing_job_id():
+    workdir = tempfile.mkdtemp(dir=tempdir)
+    env = fake_scheduler(workdir, sbatch=FAKE_SBATCH)
+    with open(os.path.join(workdir, 'workflow.ini'), 'w') as f:
+        f.write('[fit]\ntemplate = echo {1}\nargs = 1 2 3\nchunksize = 2\n\n'
+                '[summary]\ncommand_file = summary.txt\ndepends = fit\n')
+    with open(os.path.join(workdir, 'summary.txt'), 'w') as f:
+        f.write('echo done\n')
+
+    workflow = 'qbatch --env none -b slurm --workflow workflow.ini'
+    p = Popen(shlex.split(workflow), cwd=workdir, stdout=PIPE, stderr=STDOUT,
+              env=env)
+    out, _ = p.communicate()
+
+    assert p.returncode == 0, out
+    with open(os.path.join(tempdir, 'fit.array')) as script:
+        assert '#SBATCH --array=1-2' in script.read().splitlines()
+    with open(os.path.join(tempdir, 'summary.0')) as script:
+        assert '#SBATCH --dependency=afterok:1' in script.read().splitlines()
+
+    # stages depending on a job whose ID cannot be found are not submitted
+    env = fake_scheduler(workdir, sbatch='echo "$@" >> {0}/submitted\n'
+                         'echo queued\n')
+    os.remove(os.path.join(workdir, 'submitted'))
+    p = Popen(shlex.split(workflow), cwd=workdir, stdout=PIPE, stderr=STDOUT,
+              env=env)
+    out, _ = p.communicate()
+
+    assert p.returncode != 0
+    assert b'could not find the job ID' in out
+    with open(os.path.join(workdir, 'submitted')) as f:
+        assert len(f.read().splitlines()) == 1
+
+
+def test_run_qbatch_slurm_split_across_queues():
+    workdir = tempfile.mkdtemp(dir=tempdir)
+    env = fake_scheduler(workdir, sbatch=FAKE_SBATCH)
+
+    job_name = 'test_run_qbatch_slurm_split_across_queues'
+    cmds = "\n".join(['echo {0}'.format(x) for x in range(8)])
+    p = Popen(shlex.split('qbatch -N {0} --env none -b slurm -c 1 \
+                          -q short,long --queue-weights 3,1 -'.format(
+                              job_name)),
+              cwd=workdir, stdin=PIPE, stdout=PIPE, stderr=STDOUT, env=env)
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    assert p.returncode == 0, out
+    array_script = os.path.join(tempdir, job_name + '.array')
+    with open(os.path.join(workdir, 'submitted')) as f:
+        assert f.read().splitlines() == [
+            '--partition=short --array=1-6 ' + array_script,
+            '--partition=long --array=7-8 ' + array_script]
+
+
+def test_run_qbatch_slurm_split_by_free_capacity():
+    workdir = tempfile.mkdtemp(dir=tempdir)
+    env = fake_scheduler(
+        workdir, sbatch=FAKE_SBATCH,
+        sinfo='echo "small 0/64/0/64"\n'
+              'echo "large 30000/1000/0/31000"\n'
+              'echo "large 0/1000/0/1000"\n',
+        squeue='case "$*" in *--states=PD*)\n'
+               '    for i in $(seq 10); do echo "large 32"; done ;;\n'
+               'esac\n')
+
+    # the small idle partition has far less free capacity than the large one
+    job_name = 'test_run_qbatch_slurm_split_by_free_capacity'
+    cmds = "\n".join(['echo {0}'.format(x) for x in range(8)])
+    p = Popen(shlex.split('qbatch -N {0} --env none -b slurm -c 1 \
+                          -q small,large -'.format(job_name)),
+              cwd=workdir, stdin=PIPE, stdout=PIPE, stderr=STDOUT, env=env)
+    out, _ = p.communicate(cmds.encode('utf-8'))
+    assert p.returncode == 0, out
+    assert b'small=0, large=8' in out
+
+    # a retry is resubmitted to a single queue
+    os.remove(os.path.join(workdir, 'submitted'))
+    p = Popen(shlex.split('qbatch -b slurm --retry {0} -q small,large'.format(
+        job_name)), cwd=workdir, stdout=PIPE, stderr=STDOUT, env=env)
+    out, _ = p.communicate()
+    assert p.returncode == 0, out
+    array_script = os.path.join(tempdir, job_name + '.array')
+    with open(os.path.join(workdir, 'submitted')) as f:
+        assert f.read().splitlines() == [
+            '--array=1-8 --partition=large ' + array_script]
+
+
+def test_run_qbatch_slurm_retry_failed_elements():
+    workdir = tempfile.mkdtemp(dir=tempdir)
+    env = fake_scheduler(workdir, sbatch=FAKE_SBATCH, squeue='true\n')
+
+    job_name = 'test_run_qbatch_slurm_retry_failed_elements'
+    array_script = os.path.join(tempdir, job_name + '.array')
+    succeeded = os.path.join(tempdir, job_name + '.succeeded')
+    submit = 'qbatch -N {0} --env none -n -b slurm -c 1 -'.format(job_name)
+    cmds = "\n".join(['echo {0}'.format(x) for x in range(6)])
+    p = Popen(shlex.split(submit), cwd=workdir, stdin=PIPE, stdout=PIPE,
+              stderr=STDOUT, env=env)
+    out, _ = p.communicate(cmds.encode('utf-8'))
+    assert p.returncode == 0, out
+
+    for index in [1, 2, 5]:
+        open(os.path.join(succeeded, str(index)), 'w').close()
+
+    retry = 'qbatch -b slurm --retry {0} --mem 4G --max-retries 1'.format(
+        job_name)
+    p = Popen(shlex.split(retry), cwd=workdir, stdout=PIPE, stderr=STDOUT,
+              env=env)
+    out, _ = p.communicate()
+    assert p.returncode == 0, out
+    with open(os.path.join(workdir, 'submitted')) as f:
+        assert f.read().splitlines() == [
+            '--array=3-4,6 --mem=4G ' + array_script]
+
+    p = Popen(shlex.split(retry), cwd=workdir, stdout=PIPE, stderr=STDOUT,
+              env=env)
+    out, _ = p.communicate()
+    assert p.returncode != 0
+    assert b'--max-retries' in out
+
+    # submitting the job again starts its retries afresh
+    p = Popen(shlex.split(submit), cwd=workdir, stdin=PIPE, stdout=PIPE,
+              stderr=STDOUT, env=env)
+    out, _ = p.communicate(cmds.encode('utf-8'))
+    assert p.returncode == 0, out
+    assert os.listdir(succeeded) == []
+    assert not os.path.exists(os.path.join(tempdir, job_name + '.retries'))
+
+    open(os.path.join(succeeded, '1'), 'w').close()
+    p = Popen(shlex.split(retry), cwd=workdir, stdout=PIPE, stderr=STDOUT,
+              env=env)
+    out, _ = p.communicate()
+    assert p.returncode == 0, out
+    with open(os.path.join(workdir, 'submitted')) as f:
+        assert f.read().splitlines()[-1] == \
+            '--array=2-6 --mem=4G ' + array_script
+
+    # a non-array submission under the same name leaves nothing to retry
+    p = Popen(shlex.split('qbatch -N {0} --env none -n -b slurm \
+                          -- echo 1'.format(job_name)),
+              cwd=workdir, stdout=PIPE, stderr=STDOUT, env=env)
+    out, _ = p.communicate()
+    assert p.returncode == 0, out
+    p = Popen(shlex.split(retry), cwd=workdir, stdout=PIPE, stderr=STDOUT,
+              env=env)
+    out, _ = p.communicate()
+    assert p.returncode != 0
+    assert b'no record' in out
+
+    # dynamic jobs cannot be retried
+    p = Popen(shlex.split(submit[:-1] + '--dynamic -'), cwd=workdir,
+              stdin=PIPE, stdout=PIPE, stderr=STDOUT, env=env)
+    out, _ = p.communicate(cmds.encode('utf-8'))
+    assert p.returncode == 0, out
+    p = Popen(shlex.split(retry), cwd=workdir, stdout=PIPE, stderr=STDOUT,
+              env=env)
+    out, _ = p.communicate()
+    assert p.returncode != 0
+    assert b'--retry does not support --dynamic jobs' in out
+
+
+def test_run_qbatch_dryrun_pin():
+    cmds = "\n".join(['echo {0}'.format(x) for x in range(4)])
+    p = command_pipe('qbatch -N test_run_qbatch_dryrun_pin --env none -n \
+                     -b slurm -c 4 -j 2 --ppj 4 --pin --shell /bin/bash -')
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    assert p.returncode == 0, out
+    pin_shell = os.path.join(tempdir, 'test_run_qbatch_dryrun_pin.pin')
+    assert os.access(pin_shell, os.X_OK)
+    # commands run in the job's shell, not the submitter's login shell
+    with open(pin_shell) as script:
+        assert 'exec /bin/bash "$@"' in script.read().splitlines()
+    pin = Popen([pin_shell, '-c', 'echo $BASH_VERSION'], stdout=PIPE,
+                env=dict(myenv, SHELL='/bin/false'))
+    out, _ = pin.communicate()
+    assert pin.returncode == 0 and out.strip(), out
+    with open(os.path.join(tempdir, 'test_run_qbatch_dryrun_pin.0')) as script:
+        lines = script.read().splitlines()
+    assert 'QBATCH_PIN_SHELL="{0}"'.format(pin_shell) in lines
+    assert any(line.startswith('qbatch_pin parallel') for line in lines)
+
+    p = command_pipe('qbatch --env none -n -b slurm --pin --micro -- echo')
+    out, _ = p.communicate()
+    assert p.returncode != 0
+
+
+def test_run_qbatch_slurm_dryrun_array_dynamic():
+    outputs = list(range(25))
+    job_name = 'test_run_qbatch_slurm_dryrun_array_dynamic'
+    cmds = "\n".join(['echo {0}'.format(x) for x in outputs])
+    p = command_pipe('qbatch -N {0} --env none -n -j2 -b slurm -c 10 \
+                     --dynamic -'.format(job_name))
+    out, _ = p.communicate(cmds.encode('utf-8'))
+
+    array_script = os.path.join(tempdir, job_name + '.array')
+    assert p.returncode == 0, out
+    with open(array_script) as script:
+        assert '#SBATCH --array=1-3' in script.read().splitlines()
+
+    # a lock left behind by a killed job on this host is broken
+    lock = os.path.join(tempdir, job_name + '.queue.lock')
+    os.mkdir(lock)
+    with open(os.path.join(lock, 'owner'), 'w') as f:
+        f.write('{0} 999999999 1\n'.format(
+            check_output(['hostname']).decode().strip()))
+
+    # the first element to run takes every command from the shared queue
+    lines = []
+    for chunk in range(1, 4):
+        if chunk == 2:
+            # so is a lock whose lease has run out, whichever host held it
+            os.mkdir(lock)
+            with open(os.path.join(lock, 'owner'), 'w') as f:
+                f.write('otherhost 1 1\n')
+            os.utime(os.path.join(lock, 'owner'), (0, 0))
+        myenv['SLURM_ARRAY_TASK_ID'] = str(chunk)
+        array_pipe = Popen([array_script], stdout=PIPE, env=myenv)
+        out, _ = array_pipe.communicate(timeout=60)
+
+        assert array_pipe.returncode == 0, \
+            "Chunk {0}: return code = {1}".format(chunk, array_pipe.returncode)
+        lines += out.decode().splitlines()
+    assert sorted(lines) == sorted(['echo {0}\t{0}'.format(x)
+                                    for x in outputs])
+
+
+def test_run_qbatch_slurm_dryrun_array_template():
+    job_name = 'test_run_qbatch_slurm_dryrun_array_template'
+    values = os.path.join(tempdir, job_name + '.values')
+    with open(values, 'w') as f:
+        f.write('a\nb\n')
+    p = command_pipe('qbatch -N {0} --env none -n -b slurm -c 4 --micro \
+                     --template "echo {{1}}-{{2}}" --args "1 2 3" \
+                     --args-file {1}'.format(job_name, values))
+    out, _ = p.communicate()
+
+    array_script = os.path.join(tempdir, job_name + '.array')
+    assert p.returncode == 0, out
+    with open(array_script) as script:
+        lines = script.read().splitlines()
+    assert '#SBATCH --array=1-2' in lines
+    assert 'echo 1-a' not in lines
+
+    commands = ['echo {0}-{1}'.format(x, y) for x in '123' for y in 'ab']
+    for chunk in range(1, 3):
+        myenv['SLURM_ARRAY_TASK_ID'] = str(chunk)
+        expected = ['{0}\t{1}'.format(x, x[5:]) for x in commands[(
+            chunk - 1) * 4:chunk * 4]]
+        array_pipe = Popen([array_script], stdout=PIPE, env=myenv)
+        out, _ = array_pipe.communicate()
+
+        assert array_pipe.returncode == 0, \
+            "Chunk {0}: return code = {1}".format(chunk, array_pipe.returncode)
+        assert set(out.decode().splitlines()) == set(expected), \
+            "Chunk {0}: Expected {1} but got {2}".format(chunk, expected, out)